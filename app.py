@@ -1,24 +1,59 @@
 # app.py
-from flask import Flask, render_template, request, send_file
-from io import BytesIO
+from flask import Flask, render_template, request, Response
+import zipfile, os, hashlib, logging, queue, atexit, functools, multiprocessing
+import time, uuid, random, threading
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Callable, Optional
 import menu_generator
 
 app = Flask(__name__)
+menu_generator.warm_up()
 
-# --- add near the top of app.py ---
-import time, uuid
-from flask import Flask, render_template, request, send_file
+# Logging goes through a queue: request threads only enqueue, a listener thread does the
+# stderr writes. Identical errors within LOG_DEDUPE_SECS are dropped so an upstream
+# outage (every request failing the same way) doesn't turn into a log storm.
+LOG_DEDUPE_SECS = 1.0
 
-app = Flask(__name__)
+class _DedupeFilter(logging.Filter):
+    def __init__(self, window):
+        super().__init__()
+        self.window = window
+        self._last_seen = {}  # (level, message, exception text) -> monotonic ts
+
+    def filter(self, record):
+        key = (record.levelno, record.getMessage(), str(record.exc_info[1]) if record.exc_info else None)
+        now = time.monotonic()
+        if now - self._last_seen.get(key, float("-inf")) < self.window:
+            return False
+        if len(self._last_seen) > 1000:
+            self._last_seen.clear()
+        self._last_seen[key] = now
+        return True
+
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.addFilter(_DedupeFilter(LOG_DEDUPE_SECS))
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.INFO)
+_log.addHandler(_queue_handler)
+_log.propagate = False
 
 # Track client activity so the launcher can shut down on idle
-_last_request_ts = time.time()
 _open_clients = {}  # client_id -> last_seen_epoch
+activity_event = threading.Event()  # set on every request; run.py's idle watcher sleeps on it
 
 @app.before_request
 def _touch_last_request():
-    global _last_request_ts
-    _last_request_ts = time.time()
+    activity_event.set()
 
 @app.route("/client-init", methods=["POST"])
 def client_init():
@@ -40,12 +75,8 @@ def client_bye():
         _open_clients.pop(cid, None)
     return "ok", 200
 
-def get_last_request():
-    """Used by run.py to check idle time."""
-    return _last_request_ts
-
 def get_open_client_count():
-    """Used by run.py to decide if any tabs are still around."""
+    """How many tabs are still registered (sent init/pings and no bye)."""
     # prune stale entries (e.g., a tab crashed and never sent 'bye')
     now = time.time()
     stale_cutoff = now - 180  # 3 minutes
@@ -54,95 +85,322 @@ def get_open_client_count():
         _open_clients.pop(cid, None)
     return len(_open_clients)
 
+# Rendered-PDF cache: identical (store, menu_choice) requests within the TTL skip both
+# the POSaBIT fetch and the ReportLab build. The last good copy never expires and is
+# served if POSaBIT is down.
+PDF_CACHE_TTL = {"flower": 30, "preroll": 60, "cart": 60, "dab": 60, "prepack": 300}  # seconds, by api menu type
+PDF_CACHE_JITTER = 5  # spread expiries so stores don't all refetch at once
+_pdf_cache = {}      # (store, menu_choice) -> (expires_at_epoch, (pdf_bytes, etag))
+_pdf_last_good = {}  # (store, menu_choice) -> (pdf_bytes, etag)
+_pdf_cache_lock = threading.Lock()
+
+def _get_cached_pdf(key):
+    """(pdf_bytes, etag) if a fresh copy is cached, else None."""
+    with _pdf_cache_lock:
+        entry = _pdf_cache.get(key)
+    if entry and entry[0] > time.time():
+        return entry[1]
+    return None
+
+def _put_cached_pdf(key, api_menu_type, pdf_bytes, etag):
+    ttl = PDF_CACHE_TTL.get(api_menu_type, 60) + random.uniform(0, PDF_CACHE_JITTER)
+    with _pdf_cache_lock:
+        _pdf_cache[key] = (time.time() + ttl, (pdf_bytes, etag))
+        _pdf_last_good[key] = (pdf_bytes, etag)
+
+def _unchanged_pdf(key, api_menu_type, etag):
+    """The last good (pdf_bytes, etag) if it was rendered from this very feed (same digest),
+    re-armed in the cache; None if the feed changed and a render is needed."""
+    last = _pdf_last_good.get(key)
+    if last is None or last[1] != etag: return None
+    _put_cached_pdf(key, api_menu_type, *last)
+    return last
+
+def _pdf_etag(store, menu_choice, raw_data):
+    """Same store + menu + upstream feed => same PDF, so the feed digest identifies it."""
+    h = hashlib.blake2b(f"{store}|{menu_choice}|".encode(), digest_size=16)
+    h.update(menu_generator.feed_digest(store, MENU_SPECS[menu_choice].api_type, raw_data))
+    return h.hexdigest()
+
 
-# Map dropdown choices to extractors and generators
-MENU_GENERATOR_MAP = {
+@dataclass(frozen=True)
+class MenuSpec:
+    api_type: str                 # POSaBIT feed to fetch
+    extractor: Callable           # raw feed -> processed data
+    generator: Callable           # processed data -> PDF bytes (module-level, so it pickles to the render pool)
+    title: Optional[str] = None   # passed positionally to generators that take a menu title
+
+# Dropdown choice -> how to build it
+MENU_SPECS = {
     # Flower (needs store for highlight scoping)
-    "flower": {
-        "data_extractor": menu_generator.extract_flower_data,
-        "pdf_generator": lambda items, store=None: menu_generator.generate_flower_pdf(items, store=store),
-    },
+    "flower":            MenuSpec("flower",  menu_generator.extract_flower_data,  menu_generator.generate_flower_pdf),
     # Preroll
-    "preroll": {
-        "data_extractor": menu_generator.group_preroll_items,
-        "pdf_generator": lambda items, store=None: menu_generator.generate_preroll_pdf(items, store=store),
-    },
-    "preroll_condensed": {
-        "data_extractor": menu_generator.group_preroll_items,
-        "pdf_generator": lambda items, store=None: menu_generator.generate_preroll_pdf_condensed(items, store=store),
-    },
+    "preroll":           MenuSpec("preroll", menu_generator.group_preroll_items,  menu_generator.generate_preroll_pdf),
+    "preroll_condensed": MenuSpec("preroll", menu_generator.group_preroll_items,  menu_generator.generate_preroll_pdf_condensed),
     # Cart
-    "cart": {
-        "data_extractor": menu_generator.extract_all_items,
-        "pdf_generator": lambda items, store=None: menu_generator.generate_cart_dab_pdf(items, "CART MENU", store=store),
-    },
-    "cart_condensed": {
-        "data_extractor": menu_generator.extract_all_items,
-        "pdf_generator": lambda items, store=None: menu_generator.generate_cart_dab_pdf_condensed(items, "CART MENU", store=store),
-    },
+    "cart":              MenuSpec("cart",    menu_generator.extract_all_items,    menu_generator.generate_cart_dab_pdf, "CART MENU"),
+    "cart_condensed":    MenuSpec("cart",    menu_generator.extract_all_items,    menu_generator.generate_cart_dab_pdf_condensed, "CART MENU"),
     # Dab
-    "dab": {
-        "data_extractor": menu_generator.extract_all_items,
-        "pdf_generator": lambda items, store=None: menu_generator.generate_cart_dab_pdf(items, "DAB MENU", store=store),
-    },
-    "dab_condensed": {
-        "data_extractor": menu_generator.extract_all_items,
-        "pdf_generator": lambda items, store=None: menu_generator.generate_cart_dab_pdf_condensed(items, "DAB MENU", store=store),
-    },
+    "dab":               MenuSpec("dab",     menu_generator.extract_all_items,    menu_generator.generate_cart_dab_pdf, "DAB MENU"),
+    "dab_condensed":     MenuSpec("dab",     menu_generator.extract_all_items,    menu_generator.generate_cart_dab_pdf_condensed, "DAB MENU"),
     # Prepack
-    "prepack": {
-        "data_extractor": menu_generator.extract_all_items,
-        "pdf_generator": lambda items, store=None: menu_generator.generate_prepack_pdf(items, store=store),
-    },
-    "prepack_condensed": {
-        "data_extractor": menu_generator.extract_all_items,
-        "pdf_generator": lambda items, store=None: menu_generator.generate_prepack_pdf_condensed(items, store=store),
-    },
+    "prepack":           MenuSpec("prepack", menu_generator.extract_all_items,    menu_generator.generate_prepack_pdf),
+    "prepack_condensed": MenuSpec("prepack", menu_generator.extract_all_items,    menu_generator.generate_prepack_pdf_condensed),
 }
 
+# Checked before any work so garbage input never triggers an upstream POSaBIT call
+_VALID_STORES = frozenset(menu_generator.STORE_CONFIG)
+_VALID_MENU_CHOICES = frozenset(MENU_SPECS)
+
+# PDF builds are CPU-bound ReportLab work; run them in worker processes so concurrent
+# requests render in parallel instead of taking turns on the GIL. Created on first use.
+# Each gunicorn worker gets its own pool, so split the cores between them rather than
+# starting cores x workers ReportLab processes.
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS",
+                                    max(1, (os.cpu_count() or 1) // int(os.environ.get("WEB_CONCURRENCY", 1)))))
+RENDER_TIMEOUT_SECS = 60
+_render_pool = None
+_render_pool_lock = threading.Lock()
+# Single-flight: identical renders already running are shared, not repeated.
+_inflight = {}  # (store, menu_choice, etag) -> Future
+
+def _new_render_pool():
+    # Never fork a threaded server worker (another request thread may be holding a lock the
+    # child would inherit locked); start renderers fresh and let warm_up load the fonts.
+    start = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=RENDER_WORKERS, initializer=menu_generator.warm_up,
+                               mp_context=multiprocessing.get_context(start))
+
+def _submit_render(spec, processed_data, store, flight_key):
+    global _render_pool
+    with _render_pool_lock:
+        future = _inflight.get(flight_key)
+        if future is not None:
+            return future
+        if _render_pool is None:
+            _render_pool = _new_render_pool()
+        args = (processed_data, spec.title) if spec.title else (processed_data,)
+        try:
+            future = _render_pool.submit(spec.generator, *args, store=store)
+        except BrokenProcessPool:
+            # A worker died (OOM kill etc.) and the executor refuses all further work;
+            # swap in a fresh pool rather than failing every request from here on.
+            _log.warning("render pool broken, restarting it")
+            _render_pool.shutdown(wait=False)
+            _render_pool = _new_render_pool()
+            future = _render_pool.submit(spec.generator, *args, store=store)
+        _inflight[flight_key] = future
+    future.add_done_callback(lambda f: _forget_render(flight_key, f))
+    return future
+
+def _forget_render(flight_key, future):
+    with _render_pool_lock:
+        if _inflight.get(flight_key) is future:
+            del _inflight[flight_key]
+
+_index_html = None  # index.html takes no per-request context, so it's rendered once
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    global _index_html
+    if _index_html is None or app.debug:  # re-render in debug so template edits show up
+        _index_html = render_template('index.html')
+    return Response(_index_html, mimetype='text/html', headers={'Cache-Control': 'public, max-age=300'})
+
+def _not_modified(etag):
+    """If-None-Match hit. Only GET/HEAD may answer 304 (RFC 9110 13.1.2); the form POST is
+    never conditional."""
+    return request.method in ('GET', 'HEAD') and request.if_none_match.contains(etag)
 
-@app.route('/generate', methods=['POST'])
+def _pdf_response(pdf_bytes, etag, store, menu_choice):
+    if _not_modified(etag):
+        resp = Response(status=304)
+    else:
+        # the PDF is already in memory, so it goes out as the response body as-is
+        resp = Response(
+            pdf_bytes,
+            mimetype='application/pdf',
+            headers={'Content-Disposition': f'attachment; filename={store}_{menu_choice}_menu.pdf'}
+        )
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'private, max-age=30'
+    return resp
+
+# Extractors return either a flat item list or a {category: [items]} dict (prerolls)
+@functools.singledispatch
+def _has_items(processed_data):
+    return bool(processed_data)
+
+@_has_items.register
+def _(processed_data: dict):
+    return any(processed_data.values())
+
+# POST from the form; GET /generate?store=..&menu_type=.. is the cacheable, revalidatable form
+@app.route('/generate', methods=['GET', 'POST'])
 def generate_pdf():
+    store = request.values.get('store')             # foster | sandy | division
+    menu_choice = request.values.get('menu_type')   # e.g. "preroll_condensed"
+    if store not in _VALID_STORES or menu_choice not in _VALID_MENU_CHOICES:
+        return "Error: Invalid store or menu type selected.", 400
+    if len(request.values.getlist('menu_type')) > 1:  # the picker is multi-select; one PDF per request here
+        return "Error: Select one menu type, or use Download Selected (ZIP) for several.", 400
     try:
-        store = request.form.get('store')             # foster | sandy | division
-        menu_choice = request.form.get('menu_type')   # e.g. "preroll_condensed"
+        spec = MENU_SPECS[menu_choice]
 
-        generator_info = MENU_GENERATOR_MAP.get(menu_choice)
-        if not generator_info:
-            return "Error: Invalid menu type selected.", 400
+        cache_key = (store, menu_choice)
+        cached = _get_cached_pdf(cache_key)
+        if cached is not None:
+            return _pdf_response(*cached, store, menu_choice)
 
-        api_menu_type = menu_choice.split('_')[0]
+        api_menu_type = spec.api_type
         raw_data = menu_generator.fetch_menu_data(store, api_menu_type)
         if not raw_data:
+            stale = _pdf_last_good.get(cache_key)
+            if stale is not None:
+                return _pdf_response(*stale, store, menu_choice)
             return f"Error: Could not fetch data for {store} {api_menu_type}.", 500
 
-        data_extractor = generator_info['data_extractor']
-        processed_data = data_extractor(raw_data)
+        etag = _pdf_etag(store, menu_choice, raw_data)
+        if _not_modified(etag):  # client already has this exact PDF; skip the render
+            return _pdf_response(None, etag, store, menu_choice)
+        unchanged = _unchanged_pdf(cache_key, api_menu_type, etag)  # TTL lapsed but feed didn't move
+        if unchanged is not None:
+            return _pdf_response(*unchanged, store, menu_choice)
 
-        has_items = bool(
-            processed_data and (
-                any(processed_data.values()) if isinstance(processed_data, dict)
-                else len(processed_data) > 0
-            )
-        )
-        if not has_items:
+        processed_data = spec.extractor(raw_data)
+
+        if not _has_items(processed_data):
             return f"No items found for the selected menu ({menu_choice}).", 404
 
-        pdf_generator = generator_info['pdf_generator']
-        pdf_bytes = pdf_generator(processed_data, store=store)  # pass store to all generators
+        future = _submit_render(spec, processed_data, store, (store, menu_choice, etag))  # pass store to all generators
+        pdf_bytes = future.result(timeout=RENDER_TIMEOUT_SECS)
+        _put_cached_pdf(cache_key, api_menu_type, pdf_bytes, etag)
 
-        return send_file(
-            BytesIO(pdf_bytes),
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name=f'{store}_{menu_choice}_menu.pdf'
-        )
-    except Exception as e:
-        print(f"An error occurred: {e}")
+        return _pdf_response(pdf_bytes, etag, store, menu_choice)
+    except Exception:
+        _log.exception("generate_pdf failed store=%s menu=%s", store, menu_choice)
         return "An unexpected error occurred while generating the PDF.", 500
 
+class _ZipChunkSink:
+    """Write-only target for ZipFile; hands back whatever was written since the last drain."""
+    def __init__(self):
+        self._chunks = []
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    def flush(self):
+        pass
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+def _stream_zip(store, results):
+    """Yield the ZIP a member at a time, as each render finishes, instead of after all of them."""
+    sink = _ZipChunkSink()  # not seekable, so zipfile writes data descriptors and never seeks back
+    try:
+        # PDFs are already compressed, so store rather than deflate
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:
+            for menu_choice, pdf_bytes, etag in results:
+                try:
+                    pdf_bytes = _render_result(store, menu_choice, pdf_bytes, etag)
+                except Exception:
+                    # headers are already sent, so a failed menu becomes a note in the archive
+                    # rather than a truncated (unopenable) ZIP
+                    _log.exception("generate_bulk render failed store=%s menu=%s", store, menu_choice)
+                    zf.writestr(f'{store}_{menu_choice}_ERROR.txt',
+                                "An unexpected error occurred while generating this PDF.\n")
+                else:
+                    zf.writestr(f'{store}_{menu_choice}_menu.pdf', pdf_bytes)
+                yield from sink.drain()
+        yield from sink.drain()
+    except Exception:
+        # the archive itself failed to write; all we can do is cut the stream short
+        _log.exception("generate_bulk stream failed store=%s", store)
+
+def _render_result(store, menu_choice, pdf_or_future, etag):
+    """Wait for a submitted render (cached bytes pass straight through) and cache what it made."""
+    if isinstance(pdf_or_future, bytes):
+        return pdf_or_future
+    pdf_bytes = pdf_or_future.result(timeout=RENDER_TIMEOUT_SECS)
+    _put_cached_pdf((store, menu_choice), MENU_SPECS[menu_choice].api_type, pdf_bytes, etag)
+    return pdf_bytes
+
+def _start_renders(store, menu_choices, stop_on_missing=True):
+    """Kick off every render a set of menus needs, fetching/extracting each feed once.
+    Returns (results, missing): results are (menu_choice, pdf bytes or render future, etag) in
+    request order; missing lists feeds that couldn't be fetched and had no stale PDF to fall
+    back on. With stop_on_missing nothing is submitted if any feed is missing, so a request
+    that is going to fail doesn't leave orphaned renders in the pool."""
+    cached_by_choice = {c: _get_cached_pdf((store, c)) for c in menu_choices}
+    # every feed still needed, fetched in parallel: api_menu_type -> raw feed
+    raw_by_type = menu_generator.fetch_all_menus(
+        store, list(dict.fromkeys(MENU_SPECS[c].api_type for c, hit in cached_by_choice.items() if hit is None)))
+    missing = list(dict.fromkeys(
+        MENU_SPECS[c].api_type for c, hit in cached_by_choice.items()
+        if hit is None and not raw_by_type.get(MENU_SPECS[c].api_type) and _pdf_last_good.get((store, c)) is None))
+    if missing and stop_on_missing:
+        return [], missing
+    processed_by_key = {}   # (api_menu_type, extractor) -> extracted data
+    results = []
+    for menu_choice in menu_choices:
+        spec = MENU_SPECS[menu_choice]
+        api_menu_type = spec.api_type
+        cache_key = (store, menu_choice)
+
+        cached = cached_by_choice[menu_choice]
+        if cached is not None:
+            results.append((menu_choice, *cached))
+            continue
+        raw_data = raw_by_type.get(api_menu_type)
+        if not raw_data:
+            stale = _pdf_last_good.get(cache_key)
+            if stale is not None:  # None: already listed in missing
+                results.append((menu_choice, *stale))
+            continue
+        etag = _pdf_etag(store, menu_choice, raw_data)
+        unchanged = _unchanged_pdf(cache_key, api_menu_type, etag)
+        if unchanged is not None:
+            results.append((menu_choice, *unchanged))
+            continue
+        extract_key = (api_menu_type, spec.extractor)
+        if extract_key not in processed_by_key:
+            processed_by_key[extract_key] = spec.extractor(raw_data)
+        processed_data = processed_by_key[extract_key]
+        if not _has_items(processed_data):
+            continue
+        # submit every render before waiting on any, so they build side by side in the pool
+        results.append((menu_choice, _submit_render(spec, processed_data, store, (store, menu_choice, etag)), etag))
+    return results, missing
+
+def generate_all_store_pdfs(store, menu_choices=None):
+    """{menu_choice: pdf bytes} for every menu of a store (or just menu_choices), rendered in
+    parallel on the render pool. Menus with no items, or whose feed is down, are left out."""
+    results, _ = _start_renders(store, list(menu_choices or MENU_SPECS), stop_on_missing=False)
+    return {c: _render_result(store, c, pdf, etag) for c, pdf, etag in results}
+
+@app.route('/generate_bulk', methods=['POST'])
+def generate_bulk():
+    """Render several menus for one store into a ZIP, fetching/extracting each feed once."""
+    store = request.form.get('store')
+    menu_choices = list(dict.fromkeys(request.form.getlist('menu_type')))  # dedupe, keep order
+    if store not in _VALID_STORES or not menu_choices or not _VALID_MENU_CHOICES.issuperset(menu_choices):
+        return "Error: Invalid store or menu type selected.", 400
+    try:
+        results, missing = _start_renders(store, menu_choices)
+        if missing:
+            return f"Error: Could not fetch data for {store} {missing[0]}.", 500
+        if not results:
+            return "No items found for the selected menus.", 404
+
+        # chunked transfer: the first PDF goes out as soon as it's rendered
+        return Response(
+            _stream_zip(store, results),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename={store}_menus.zip'}
+        )
+    except Exception:
+        _log.exception("generate_bulk failed store=%s menus=%s", store, menu_choices)
+        return "An unexpected error occurred while generating the PDFs.", 500
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    app.run(debug=True, threaded=True)
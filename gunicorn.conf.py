@@ -0,0 +1,17 @@
+# gunicorn.conf.py
+# Picked up automatically by `gunicorn app:app`.
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+
+# /generate spends most of its time blocked on the POSaBIT fetch, so use threaded
+# workers: one process per core, several requests in flight per process.
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+os.environ["WEB_CONCURRENCY"] = str(workers)  # app.py divides the render pool by this
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# a hung upstream fetch gives up after one 20s read (menu_generator.FETCH_TIMEOUT, read
+# timeouts are not retried); leave room for the PDF build on top
+timeout = 60
+keepalive = 5
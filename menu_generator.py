@@ -1,10 +1,23 @@
 # menu_generator.py
-import requests, re
+import requests, re, threading, time, functools, hashlib, os, stat, tempfile
+from collections import namedtuple, defaultdict
+from operator import itemgetter
+from itertools import accumulate, chain
+try:  # C JSON codec when the wheel is available; stdlib otherwise (e.g. bare desktop builds)
+    import orjson
+    json_loads, json_dumps = orjson.loads, orjson.dumps
+except ImportError:
+    import json
+    json_loads = json.loads
+    def json_dumps(obj): return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import (
     BaseDocTemplate, Frame, PageTemplate, Paragraph, Spacer,
-    Table, TableStyle, PageBreak, KeepTogether, SimpleDocTemplate
+    Table, TableStyle, PageBreak, KeepTogether, CondPageBreak, SimpleDocTemplate
 )
 from reportlab.lib import colors
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -50,36 +63,165 @@ DEFAULT_LINEAGE_MAP = {"sativa":"S","sativa_hybrid":"SH","hybrid":"H","indica":"
 LINEAGE_COLORS = {"S":colors.red,"SH":colors.red,"H":colors.green,"I":colors.purple,"IH":colors.purple,"CBD":HexColor("#292cf0")}
 LINEAGE_ORDER = {"S":0,"SH":0.5,"H":1,"I":2,"IH":2.5,"CBD":3}
 
+# Compiled once; these run per item
+_LETTER_RE = re.compile(r"[a-zA-Z]")
+_PACK_RE = re.compile(r"(\d+)\s*(?:pk|pack)\b", re.IGNORECASE)
+_NUM_RE = re.compile(r"([\d.]+)")
+_PREROLL_KW_RE = re.compile(r"flavored|combined|infused|blunt")  # applied to lowercased text
+
+# Built once per process; generators derive their (cached) child styles from it via _style().
+_STYLES = getSampleStyleSheet()
+_FONTS = ("Helvetica", "Helvetica-Bold")
+
+def warm_up():
+    """Load the standard font metrics up front so the first request doesn't pay for it."""
+    for name in _FONTS:
+        pdfmetrics.getFont(name)
+        pdfmetrics.stringWidth("0", name, 9)
+
 # ------------------------------ Fetch & extract ------------------------------
+# Raw feed cache, keyed on the API-level (store, menu_type) so e.g. cart and cart_condensed
+# share one upstream call. Separate from the rendered-PDF cache in app.py.
+FEED_CACHE_TTL = 20  # seconds
+_feed_cache = {}      # (store, menu_type) -> (fetched_at_monotonic, feed, digest of the raw bytes)
+_feed_locks = {}      # (store, menu_type) -> Lock; single-flight for concurrent misses
+# A failed fetch is remembered briefly so callers queued on the key lock (and any arriving
+# right after) fall back at once instead of each retrying a dead upstream in turn.
+FEED_FAILURE_TTL = 5  # seconds
+_feed_failed_at = {}  # (store, menu_type) -> monotonic time of the last failed fetch
+_feed_cache_lock = threading.Lock()
+# Second tier on disk: shared by every server worker process and survives an app restart.
+# Same freshness budget as the memory tier. The directory must be private to this user
+# (anyone who can write there decides what gets rendered), so it's per-user and checked.
+FEED_DISK_DIR = os.environ.get("MENU_CACHE_DIR") or os.path.join(
+    tempfile.gettempdir(), f"menu_cache-{os.getuid() if hasattr(os, 'getuid') else 'user'}")
+
 def fetch_menu_data(store, menu_type):
+    if not STORE_CONFIG.get(store, {}).get("feeds", {}).get(menu_type): return None
+    key = (store, menu_type)
+    with _feed_cache_lock:
+        hit = _feed_cache.get(key)
+        key_lock = _feed_locks.setdefault(key, threading.Lock())
+    if hit and time.monotonic() - hit[0] < FEED_CACHE_TTL: return hit[1]
+    with key_lock:
+        hit = _feed_cache.get(key)  # filled while we waited on another caller's fetch
+        if hit and time.monotonic() - hit[0] < FEED_CACHE_TTL: return hit[1]
+        if time.monotonic() - _feed_failed_at.get(key, -FEED_FAILURE_TTL) < FEED_FAILURE_TTL: return None
+        age, feed, digest = _read_disk_feed(store, menu_type)
+        if feed is None:
+            age, (feed, digest) = 0, _fetch_menu_data_uncached(store, menu_type)
+        if feed:
+            _feed_failed_at.pop(key, None)
+            with _feed_cache_lock:
+                _feed_cache[key] = (time.monotonic() - age, feed, digest)
+        else:
+            _feed_failed_at[key] = time.monotonic()
+        return feed
+
+def _raw_digest(raw): return hashlib.blake2b(raw, digest_size=16).digest()
+
+def feed_digest(store, menu_type, feed):
+    """Digest identifying a feed returned by fetch_menu_data. Taken from the raw response bytes
+    when they were read, so this is a lookup; a feed that isn't the cached one gets hashed."""
+    with _feed_cache_lock:
+        hit = _feed_cache.get((store, menu_type))
+    if hit and hit[1] is feed: return hit[2]
+    return _raw_digest(json_dumps(feed))
+
+@functools.lru_cache(maxsize=1)
+def _disk_dir():
+    """FEED_DISK_DIR once it's known to be a real directory owned by us with no group/other
+    access, else None (disk tier off)."""
+    try:
+        os.makedirs(FEED_DISK_DIR, mode=0o700, exist_ok=True)
+        st = os.lstat(FEED_DISK_DIR)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode): return None  # symlink or file planted in its place
+    if hasattr(os, "getuid") and (st.st_uid != os.getuid() or st.st_mode & 0o077): return None
+    return FEED_DISK_DIR
+
+def _disk_feed_path(store, menu_type):
+    d = _disk_dir()
+    return os.path.join(d, f"{store}_{menu_type}.json") if d else None
+
+def _read_disk_feed(store, menu_type):
+    """(age_secs, feed, digest) if a fresh copy is on disk, else (0, None, None)."""
+    path = _disk_feed_path(store, menu_type)
+    if not path: return 0, None, None
+    try:
+        age = time.time() - os.path.getmtime(path)
+        if not 0 <= age < FEED_CACHE_TTL: return 0, None, None
+        with open(path, "rb") as f: raw = f.read()
+        return age, json_loads(raw), _raw_digest(raw)
+    except (OSError, ValueError):
+        return 0, None, None
+
+def _write_disk_feed(store, menu_type, raw):
+    path = _disk_feed_path(store, menu_type)
+    if not path: return
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")  # O_EXCL, random name
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "wb") as f: f.write(raw)
+        os.replace(tmp, path)  # atomic, so readers in other processes never see half a file
+    except OSError:
+        try: os.unlink(tmp)
+        except OSError: pass
+
+# One pooled keep-alive session for all POSaBIT calls, so repeat fetches reuse the TCP+TLS
+# connection. Everything goes to one host; pool_maxsize covers the server's request threads.
+# Only quick failures are retried (refused/reset connects, gateway errors): a read timeout
+# means POSaBIT is hung, and retrying it would hold the feed lock for minutes.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=8, pool_maxsize=16,
+    max_retries=Retry(total=2, connect=2, read=0, status=2, backoff_factor=0.2,
+                      status_forcelist=[502, 503, 504], respect_retry_after_header=False),
+))
+FETCH_TIMEOUT = (5, 20)  # (connect, read) seconds per attempt
+
+def _fetch_menu_data_uncached(store, menu_type):
+    """(feed, digest of the raw bytes), or (None, None) if it couldn't be fetched."""
     cfg = STORE_CONFIG.get(store)
-    if not cfg: return None
+    if not cfg: return None, None
     feed = cfg["feeds"].get(menu_type); token = cfg.get("api_token")
-    if not feed or not token: return None
+    if not feed or not token: return None, None
     try:
-        r = requests.get(
+        r = _SESSION.get(
             f"https://app.posabit.com/api/v1/menu_feeds/{feed}",
             headers={"Authorization": f"Bearer {token}", "Accept":"application/json"},
-            timeout=20
+            timeout=FETCH_TIMEOUT
         )
         r.raise_for_status()
-        return r.json()
+        feed = json_loads(r.content)  # bytes straight to dicts, no text decode
+        _write_disk_feed(store, menu_type, r.content)
+        return feed, _raw_digest(r.content)
     except Exception:
-        return None
+        return None, None
+
+def fetch_all_menus(store, menu_types=None):
+    """{menu_type: feed or None} for several of a store's feeds, fetched concurrently
+    (defaults to all of them). Latency is the slowest feed rather than the sum."""
+    feeds = STORE_CONFIG.get(store, {}).get("feeds", {})
+    menu_types = [t for t in (feeds if menu_types is None else menu_types) if t in feeds]
+    if not menu_types: return {}
+    with ThreadPoolExecutor(max_workers=len(menu_types)) as ex:
+        return dict(zip(menu_types, ex.map(lambda t: fetch_menu_data(store, t), menu_types)))
 
 def extract_all_items(menu_feed):
-    items = []
-    if not menu_feed: return items
-    for g in menu_feed.get("menu_feed", {}).get("menu_groups", []):
-        items.extend(g.get("menu_items", []))
-    return items
+    if not menu_feed: return []
+    groups = menu_feed.get("menu_feed", {}).get("menu_groups", ())
+    return list(chain.from_iterable(g.get("menu_items") or () for g in groups))
 
 # ------------------------------ Helpers ------------------------------
 def get_price_info(item):
     prices = item.get("prices", [])
     if prices:
         unit_raw = (prices[0].get("unit","") or "").strip()
-        if unit_raw and not re.search(r"[a-zA-Z]", unit_raw): unit_raw += "g"
+        if unit_raw and not _LETTER_RE.search(unit_raw): unit_raw += "g"
         cents = prices[0].get("price_cents", 0) or 0
         return unit_raw, cents/100.0
     return "", 0.0
@@ -90,19 +232,71 @@ def get_lineage_abbr(item):
 def get_lineage_order(abbr): return LINEAGE_ORDER.get(abbr, 99)
 def determine_lineage_color(item): return LINEAGE_COLORS.get(get_lineage_abbr(item), colors.black)
 
-def format_cbd_value(v):
+def _format_cbd_value(v):
     if v in (None,""): return "<LOQ"
     try: return "<LOQ>" if float(v)==0.0 else v
     except: return v
 
+# Feeds repeat a small set of readings ("0", "0.1", "", ...) across items and re-renders.
+# typed=True keeps 1 / 1.0 / True apart, since the value itself is what gets printed.
+_format_cbd_cached = functools.lru_cache(maxsize=1024, typed=True)(_format_cbd_value)
+
+def format_cbd_value(v):
+    try: return _format_cbd_cached(v)
+    except TypeError: return _format_cbd_value(v)  # unhashable (list/dict) readings
+
+@functools.lru_cache(maxsize=1024)
+def price_label(price): return f"${price:.2f}" if price else ""
+
+# Same strain/brand names get measured over and over (every menu, full + condensed)
+@functools.lru_cache(maxsize=8192)
+def _string_width(text, font, size):
+    return pdfmetrics.stringWidth(text, font, size)
+
+@functools.lru_cache(maxsize=16)
+def _ascii_widths(font):
+    """Per-glyph widths (1/1000 em) indexed by code 0-127, or None if the font doesn't map
+    ASCII straight through. For the standard WinAnsi Type1 fonts stringWidth of printable
+    ASCII is exactly sum(widths) * 0.001 * size (control characters go to the substitution
+    fonts instead), so prefix widths can come from one running sum."""
+    f = pdfmetrics.getFont(font)
+    if type(f) is not pdfmetrics.Font or f.encName != "WinAnsiEncoding": return None
+    return tuple(f.widths[:128])
+
+@functools.lru_cache(maxsize=16)
+def _widest_ascii(font):
+    """Widest printable ASCII glyph (1/1000 em): len(text) * this bounds the text's width."""
+    return max(_ascii_widths(font)[32:127])
+
+# Whole results memoised too: full and condensed menus truncate the same names to the same
+# column widths (widths are fixed per layout, so exact keys hit without any quantising)
+@functools.lru_cache(maxsize=4096)
 def truncate_text(text, max_w, font, size):
     if not text: return ""
-    w = pdfmetrics.stringWidth(text, font, size)
+    widths = _ascii_widths(font) if text.isascii() and text.isprintable() else None
+    if widths is not None:
+        # short text in a wide column fits even if every glyph were the widest one
+        if len(text) * _widest_ascii(font) * 0.001 * size <= max_w: return text
+        # one pass over a glyph-width table instead of a stringWidth call per probe
+        cum = list(accumulate(map(widths.__getitem__, map(ord, text))))
+        if cum[-1] * 0.001 * size <= max_w: return text
+        ew = _string_width("…", font, size)
+        lo, hi = 0, len(text) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if cum[mid - 1] * 0.001 * size + ew <= max_w: lo = mid
+            else: hi = mid - 1
+        return text[:lo] + "…"
+    w = _string_width(text, font, size)
     if w <= max_w: return text
-    ell, ew = "…", pdfmetrics.stringWidth("…", font, size)
-    while text and pdfmetrics.stringWidth(text, font, size) + ew > max_w:
-        text = text[:-1]
-    return text + ell
+    ell, ew = "…", _string_width("…", font, size)
+    # longest prefix that fits alongside the ellipsis; prefix width only grows with length
+    lo, hi = 0, len(text) - 1
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if _string_width(text[:mid], font, size) + ew <= max_w: lo = mid
+        else: hi = mid - 1
+    return text[:lo] + ell
 
 def prefer_strain(item):
     """
@@ -120,33 +314,199 @@ def prefer_strain(item):
         return parts[1]  # Brand - Strain - ...
     return name  # last resort
 
+# Every field a table row reads, derived once per item.
+# thc/cbd are the raw "current" values; item is kept for the discount-tag highlight pass.
+ItemRow = namedtuple("ItemRow", "item strain name brand thc cbd unit price lineage_abbr lineage_color")
+
+def cannabinoid(item, key):
+    """The "current" reading under item[key] ("thc"/"cbd"), or "" - no throwaway {} per call."""
+    d = item.get(key)
+    return d.get("current", "") if d else ""
+
+def to_row(item):
+    unit, price = get_price_info(item)
+    abbr = get_lineage_abbr(item)
+    return ItemRow(item, prefer_strain(item), item.get("name") or "", item.get("brand") or "",
+                   cannabinoid(item, "thc"), cannabinoid(item, "cbd"),
+                   unit, price, abbr, LINEAGE_COLORS.get(abbr, colors.black))
+
+@functools.lru_cache(maxsize=128)
+def _style(name, parent, **kw):
+    """Child of a sample-sheet style, built once per distinct set of overrides and reused by
+    every later PDF (styles are read-only once built)."""
+    return ParagraphStyle(name, parent=_STYLES[parent], **kw)
+
+@functools.lru_cache(maxsize=16)
+def lineage_styles(parent, name):
+    """One child of `parent` per lineage colour ("" = unknown, black), keyed by lineage abbr.
+    Cached for the life of the process, so every PDF and every product cell share the same
+    styles; callers must not modify them."""
+    out = {abbr: ParagraphStyle(f"{name}_{abbr}", parent=parent, textColor=c) for abbr, c in LINEAGE_COLORS.items()}
+    out[""] = ParagraphStyle(name, parent=parent, textColor=colors.black)
+    return out
+
+# The group tables in the preroll and cart/dab menus all share these commands. A TableStyle
+# is only read by Table.setStyle, so one instance per (size, padding) serves every table.
+@functools.lru_cache(maxsize=16)
+def _group_table_style(font_size, pad_lr=None, pad_tb=None):
+    cmds = [
+        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0,0), (-1,0), font_size),
+        ('BACKGROUND', (0,0), (-1,0), colors.grey),
+        ('ALIGN', (1,0), (-1,-1), 'CENTER'),
+        ('GRID', (0,0), (-1,-1), 0.25, colors.black),
+        ('FONTNAME', (0,1), (-1,-1), 'Helvetica'),
+        ('FONTSIZE', (0,1), (-1,-1), font_size),
+    ]
+    if pad_lr is not None:
+        cmds += [('LEFTPADDING', (0,0), (-1,-1), pad_lr), ('RIGHTPADDING', (0,0), (-1,-1), pad_lr),
+                 ('TOPPADDING', (0,0), (-1,-1), pad_tb), ('BOTTOMPADDING', (0,0), (-1,-1), pad_tb)]
+    return TableStyle(cmds)
+
+# Fixed halves of the prepack and flower table styles; the per-row lineage/discount colours
+# go on with a second setStyle, so only those are built per table.
+@functools.lru_cache(maxsize=16)
+def _prepack_table_style(font_size):
+    return TableStyle([
+        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0,0), (-1,0), font_size+1),
+        ('BACKGROUND', (0,0), (-1,0), colors.darkgrey),
+        ('TEXTCOLOR', (0,0), (-1,0), colors.whitesmoke),
+        ('ALIGN', (0,0), (-1,-1), 'CENTER'),
+        ('GRID', (0,0), (-1,-1), 0.5, colors.black),
+        ('FONTNAME', (0,1), (-1,-1), 'Helvetica'),
+        ('FONTSIZE', (0,1), (-1,-1), font_size),
+        ("FONTNAME", (3, 1), (3, -1), "Helvetica-Bold"),  # one range command, not one per row
+    ])
+
+@functools.lru_cache(maxsize=16)
+def _prepack_condensed_table_style(font_size, pad_lr, pad_tb):
+    return TableStyle([
+        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0,0), (-1,0), font_size),
+        ('BACKGROUND', (0,0), (-1,0), colors.grey),
+        ('TEXTCOLOR', (0,0), (-1,0), colors.whitesmoke),
+        ('ALIGN', (0,0), (-1,0), 'CENTER'),
+        ('FONTNAME', (0,1), (-1,-1), 'Helvetica'),
+        ('FONTSIZE', (0,1), (-1,-1), font_size),
+        ('LEFTPADDING', (0,0), (-1,-1), pad_lr),
+        ('RIGHTPADDING', (0,0), (-1,-1), pad_lr),
+        ('TOPPADDING', (0,0), (-1,-1), pad_tb),
+        ('BOTTOMPADDING', (0,0), (-1,-1), pad_tb),
+        ('GRID', (0,0), (-1,-1), 0.25, colors.black),
+        ("FONTNAME", (3, 1), (3, -1), "Helvetica-Bold"),
+    ])
+
+@functools.lru_cache(maxsize=16)
+def _flower_table_style(font_size, with_header):
+    """Flower sub-table style; only the first chunk of a tier has the header row."""
+    r0 = 1 if with_header else 0
+    head = [
+        ('FONTNAME',(0,0),(-1,0),'Helvetica-Bold'),
+        ('FONTSIZE',(0,0),(-1,0),font_size),
+        ('ALIGN',(0,0),(-1,0),'CENTER'),
+        ('BOTTOMPADDING',(0,0),(-1,0),font_size*0.5+4),
+    ] if with_header else []
+    return TableStyle(head + [
+        ('GRID',(0,0),(-1,-1),0.25,colors.black),
+        ('FONTNAME',(0,r0),(-1,-1),'Helvetica'),
+        ('FONTSIZE',(0,r0),(-1,-1),font_size),
+        ('LEFTPADDING',(0,0),(-1,-1),font_size*0.5),
+        ('RIGHTPADDING',(0,0),(-1,-1),font_size*0.5),
+        ('TOPPADDING',(0,0),(-1,-1),font_size*0.5),
+        ('BOTTOMPADDING',(0,0),(-1,-1),font_size*0.5),
+    ])
+
+def column_runs(op, col, values, first_row=1):
+    """One (op, (col, start), (col, end), value) command per run of the same value down a
+    column, skipping None; sorted tables repeat colours, so runs beat a command per row."""
+    cmds, start, cur = [], first_row, None
+    for i, v in enumerate(values, start=first_row):
+        if v is not cur:
+            if cur is not None: cmds.append((op, (col, start), (col, i - 1), cur))
+            start, cur = i, v
+    if cur is not None: cmds.append((op, (col, start), (col, i), cur))
+    return cmds
+
+def discount_highlights(items, store, col):
+    """BACKGROUND commands for 30%/50% off items (rows start at 1, under the header)."""
+    if not store: return []
+    return column_runs('BACKGROUND', col, [discount_color(it, store) for it in items])
+
 # Store-scoped discount matcher (tolerates suffixes like "Division St")
 def has_discount_tag_for_store(item, percent: int, store: str) -> bool:
     """
     True if item has '30 Percent OFF Division' / '50 Percent OFF Sandy ...'
     Only matches the CURRENT store (no cross-store bleed).
     """
+    return str(percent) in store_discounts(item, store)
+
+_DISCOUNT_TAG_RE = re.compile(r"(\d+) percent off (.*)", re.DOTALL)  # matched against stripped, lowercased tags
+
+def store_discounts(item, store):
+    """Percent strings ('30', '50', ...) of every discount tag on the item for this store,
+    from a single walk over tag_list."""
     tags = item.get("tag_list") or []
-    if not store or not tags: return False
-    prefix = f"{percent} percent off "
-    store_key = (store or "").strip().lower()
+    if not store or not tags: return ()
+    store_key = store.strip().lower()
+    found = []
     for t in tags:
         if not t: continue
-        tl = t.strip().lower()
-        if not tl.startswith(prefix): continue
-        after = tl.split("off ", 1)[1].strip()
-        if after.startswith(store_key):  # 'division', 'division st', etc.
-            return True
-    return False
+        m = _DISCOUNT_TAG_RE.match(t.strip().lower())
+        if m and m.group(2).strip().startswith(store_key):  # 'division', 'division st', etc.
+            found.append(m.group(1))
+    return found
+
+_DISCOUNT_COLORS = (("30", colors.yellow), ("50", colors.lightblue))  # first match wins
+
+def discount_color(item, store):
+    """Highlight colour for the item's discount at this store, or None."""
+    found = store_discounts(item, store)
+    for pct, color in _DISCOUNT_COLORS:
+        if pct in found: return color
+    return None
+
+# Every generator takes output=None: by default it builds in memory and returns the PDF bytes;
+# given a writable binary file object it builds straight into it and returns None.
+def _pdf_bytes(buffer, output):
+    if output is not None: return None
+    pdf = buffer.getvalue(); buffer.close()
+    return pdf
 
 # ------------------------------ PREROLL ------------------------------
-def group_by_brand_unit(items):
-    grouped = {}
-    for it in items:
-        brand = (it.get("brand") or "").strip()
-        unit, _ = get_price_info(it)
-        grouped.setdefault((brand, unit), []).append(it)
-    return grouped
+# A group taller than this can't fit one column anyway; KeepTogether would only burn a
+# trial layout and a frame break before splitting it, so let it flow.
+KEEP_TOGETHER_MAX_ROWS = 40
+
+def keep_group(flow, n_rows, min_space=0):
+    """KeepTogether for short groups; longer ones flow, after an optional CondPageBreak so
+    their heading isn't stranded at a column foot."""
+    if n_rows <= KEEP_TOGETHER_MAX_ROWS: return [KeepTogether(flow)]
+    return [CondPageBreak(min_space)] + flow if min_space else flow
+
+# Sorts below run over (key, payload) pairs built once, so the key lookup stays in C
+_by_key = itemgetter(0)
+
+def _row_sort_key(r):
+    return (r.price, LINEAGE_ORDER.get(r.lineage_abbr, 99), r.strain.lower())
+
+def _raw_strain_sort_key(r):
+    # the full preroll layout ties on POSaBIT's own strain field, so items without one lead
+    return (r.price, LINEAGE_ORDER.get(r.lineage_abbr, 99), (r.item.get("strain") or "").lower())
+
+def sort_preroll_groups(rows, sort_key=_row_sort_key):
+    # rows are ItemRows, so price/lineage/strain are already derived; a group's cheapest
+    # price is its first row after sorting
+    groups = defaultdict(list)
+    for r in rows:
+        groups[(r.brand.strip(), r.unit)].append((sort_key(r), r))
+    out = []
+    for (brand, unit), dec in groups.items():
+        dec.sort(key=_by_key)
+        min_price = dec[0][0][0]
+        out.append(((min_price, brand.lower(), unit.lower()), (brand, unit, min_price, [r for _, r in dec])))
+    out.sort(key=_by_key)
+    return [g for _, g in out]
 
 def process_flavored_title(title: str):
     if not title: return ""
@@ -154,9 +514,18 @@ def process_flavored_title(title: str):
 
 def extract_pack_size(title: str):
     if not title: return None
-    m = re.search(r"(\d+)\s*(?:pk|pack)\b", title, re.IGNORECASE)
+    m = _PACK_RE.search(title)
     return m.group(1) if m else None
 
+# (is_infused, is_blunt) -> category for items none of the brand/flavour/pack rules claimed
+_PLAIN_INFUSED_CATS = {(True, True): "Infused Blunts", (True, False): "Infused Prerolls",
+                       (False, True): "Plain Blunts", (False, False): "Plain Prerolls"}
+
+def _unit_weight(item):
+    prices = item.get("prices", [])
+    m = _NUM_RE.search((prices[0].get("unit") or "").lower()) if prices else None
+    return float(m.group(1)) if m else 0
+
 def determine_preroll_category(item):
     title = (item.get("name") or item.get("strain") or "").lower()
     product_type = (item.get("product_type") or "").lower()
@@ -165,27 +534,20 @@ def determine_preroll_category(item):
     if brand == "sticks":
         return "Infused Prerolls"
 
-    weight = 0
-    prices = item.get("prices", [])
-    if prices:
-        m = re.search(r"([\d.]+)", (prices[0].get("unit") or "").lower())
-        if m: weight = float(m.group(1))
-
-    if "flavored" in product_type or "combined" in product_type:
+    # one scan per field for every keyword the rules below look at
+    pt_kw, title_kw = set(_PREROLL_KW_RE.findall(product_type)), set(_PREROLL_KW_RE.findall(title))
+    if "flavored" in pt_kw or "combined" in pt_kw:
         return "Flavored"
+    weight = _unit_weight(item)  # only parsed once the cheap rules have passed
     if "hellavated" in brand:
-        if "flavored" in title or "combined" in product_type: return "Flavored"
+        if "flavored" in title_kw: return "Flavored"
         if weight >= 1.5: return "Preroll Packs"
-        if "blunt" in title: return "Infused Blunts"
+        if "blunt" in title_kw: return "Infused Blunts"
         return "Infused Prerolls"
     if weight > 2.9:
         return "Preroll Packs"
-    is_infused = ("infused" in product_type) or (brand == "portland heights")
-    is_blunt = ("blunt" in title or "blunts" in title)
-    if is_infused and is_blunt: return "Infused Blunts"
-    if is_infused: return "Infused Prerolls"
-    if is_blunt: return "Plain Blunts"
-    return "Plain Prerolls"
+    # "blunt" also covers "blunts"
+    return _PLAIN_INFUSED_CATS["infused" in pt_kw or brand == "portland heights", "blunt" in title_kw]
 
 def group_preroll_items(menu_feed):
     cats = {
@@ -195,39 +557,49 @@ def group_preroll_items(menu_feed):
     }
     for item in extract_all_items(menu_feed):
         cat = determine_preroll_category(item)
-        brand = (item.get("brand") or "").lower()
-        if cat == "Preroll Packs" and brand in ["entourage cannabis", "hellavated"]:
+        if cat == "Preroll Packs" and (item.get("brand") or "").lower() in ("entourage cannabis", "hellavated"):
             cats["Infused Preroll Packs"].append(item)
         else:
             cats[cat].append(item)
     return cats
 
-def generate_preroll_pdf(grouped_data, font_size=12, store=None):
-    buffer = BytesIO()
+PREROLL_ORDER = ["Plain Prerolls","Plain Blunts","Infused Prerolls","Infused Blunts","Flavored","Preroll Packs","Infused Preroll Packs"]
+
+def preroll_rows(grouped_data):
+    """{category: [ItemRow]} in render order; each item is derived once."""
+    return {cat: list(map(to_row, grouped_data[cat])) for cat in PREROLL_ORDER if grouped_data.get(cat)}
+
+def prepare_preroll(rows_by_cat, sort_key=_row_sort_key):
+    """{category: [(brand, unit, min_price, pack_sz, rows)]} in render order. The full layout
+    sorts with _raw_strain_sort_key, the condensed one with the printed strain (the default)."""
+    return {
+        cat: [(brand, unit, min_price, extract_pack_size(rows[0].name), rows)
+              for brand, unit, min_price, rows in sort_preroll_groups(cat_rows, sort_key)]
+        for cat, cat_rows in rows_by_cat.items()
+    }
+
+def render_preroll_both(grouped_data, store=None):
+    """(full_pdf, condensed_pdf), deriving the rows once and sorting them once per layout."""
+    rows_by_cat = preroll_rows(grouped_data)
+    return (generate_preroll_pdf(grouped_data, store=store, prepared=prepare_preroll(rows_by_cat, _raw_strain_sort_key)),
+            generate_preroll_pdf_condensed(grouped_data, store=store, prepared=prepare_preroll(rows_by_cat)))
+
+def generate_preroll_pdf(grouped_data, font_size=12, store=None, prepared=None, output=None):
+    buffer = BytesIO() if output is None else output
     doc = BaseDocTemplate(buffer, pagesize=letter, leftMargin=24, rightMargin=24, topMargin=36, bottomMargin=36)
     gap = 12
     fw, fh = (doc.width - gap) / 2, doc.height
     frames = [Frame(doc.leftMargin, doc.bottomMargin, fw, fh),
               Frame(doc.leftMargin + fw + gap, doc.bottomMargin, fw, fh)]
     doc.addPageTemplates([PageTemplate(id='TwoCol', frames=frames)])
-    styles = getSampleStyleSheet()
-    cat_header_style = ParagraphStyle("CatHeader", parent=styles["Heading1"], alignment=1, fontSize=font_size + 4)
-    sub_header_style = ParagraphStyle("SubHeader", parent=styles["Heading2"], alignment=0, fontSize=font_size + 2)
-    normal_style = ParagraphStyle("Normal", parent=styles["Normal"], fontSize=font_size)
+    cat_header_style = _style("CatHeader", "Heading1", alignment=1, fontSize=font_size + 4)
+    sub_header_style = _style("SubHeader", "Heading2", alignment=0, fontSize=font_size + 2)
+    normal_style = _style("Normal", "Normal", fontSize=font_size)
+    prod_styles = lineage_styles(normal_style, "Prod")
     elements = []
-    order = ["Plain Prerolls","Plain Blunts","Infused Prerolls","Infused Blunts","Flavored","Preroll Packs","Infused Preroll Packs"]
-    for cat in [c for c in order if grouped_data.get(c)]:
+    for cat, groups in (prepared or prepare_preroll(preroll_rows(grouped_data), _raw_strain_sort_key)).items():
         flow = [Paragraph(cat, cat_header_style), Spacer(1, 12)]
-        gmap = {
-            k: sorted(v, key=lambda i: (get_price_info(i)[1], get_lineage_order(get_lineage_abbr(i)), (i.get("strain") or "").lower()))
-            for k, v in group_by_brand_unit(grouped_data[cat]).items()
-        }
-        sorted_keys = sorted(gmap.keys(), key=lambda k: (min((get_price_info(i)[1] for i in gmap[k]), default=9e9), k[0].lower(), k[1].lower()))
-        for brand, unit in sorted_keys:
-            subitems = gmap[(brand, unit)]
-            if not subitems: continue
-            min_price = get_price_info(subitems[0])[1]
-            pack_sz = extract_pack_size(subitems[0].get("name") or "")
+        for brand, unit, min_price, pack_sz, rows in groups:
             heading = f"{brand} {unit} ${min_price:.2f}" + (f" {pack_sz} pack" if pack_sz else "")
 
             is_infused_cat = "infused" in cat.lower() or cat == "Flavored"
@@ -235,67 +607,43 @@ def generate_preroll_pdf(grouped_data, font_size=12, store=None):
 
             col_w = [fw * 0.5, fw * 0.25, fw * 0.25]
             data = [hdr]
-            for it in subitems:
-                name = process_flavored_title(it.get("name") or "") if cat == "Flavored" else prefer_strain(it)
+            for r in rows:
+                name = process_flavored_title(r.name) if cat == "Flavored" else r.strain
                 t_name = truncate_text(name, col_w[0], "Helvetica", font_size)
-                p_par = Paragraph(t_name, ParagraphStyle("Prod", parent=normal_style, textColor=determine_lineage_color(it)))
-                thc, cbd = it.get("thc", {}).get("current", ""), format_cbd_value(it.get("cbd", {}).get("current", ""))
-                data.append([p_par, thc, cbd])
+                p_par = Paragraph(t_name, prod_styles[r.lineage_abbr])
+                data.append([p_par, r.thc, format_cbd_value(r.cbd)])
 
             tbl = Table(data, colWidths=col_w)
-            sty = TableStyle([
-                ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0,0), (-1,0), font_size),
-                ('BACKGROUND', (0,0), (-1,0), colors.grey),
-                ('ALIGN', (1,0), (-1,-1), 'CENTER'),
-                ('GRID', (0,0), (-1,-1), 0.25, colors.black),
-                ('FONTNAME', (0,1), (-1,-1), 'Helvetica'),
-                ('FONTSIZE', (0,1), (-1,-1), font_size)
-            ])
-            # highlight: Product column index 0
-            for i, it in enumerate(subitems, start=1):
-                if store and has_discount_tag_for_store(it, 30, store):
-                    sty.add('BACKGROUND', (0, i), (0, i), colors.yellow)
-                elif store and has_discount_tag_for_store(it, 50, store):
-                    sty.add('BACKGROUND', (0, i), (0, i), colors.lightblue)
-            tbl.setStyle(sty)
+            tbl.setStyle(_group_table_style(font_size))
+            tbl.setStyle(discount_highlights((r.item for r in rows), store, col=0))
 
+            # category heading rides along with its first group, not the whole category
             flow.extend([Paragraph(heading, sub_header_style), Spacer(1, 6), tbl, Spacer(1, 12)])
-        elements.extend([KeepTogether(flow), Spacer(1, 24)])
+            elements.extend(keep_group(flow, len(rows)))
+            flow = []
+        elements.extend([*flow, Spacer(1, 24)])
     doc.build(elements)
-    pdf_data = buffer.getvalue()
-    buffer.close()
-    return pdf_data
+    return _pdf_bytes(buffer, output)
 
-def generate_preroll_pdf_condensed(grouped_data, store=None):
+def generate_preroll_pdf_condensed(grouped_data, store=None, prepared=None, output=None):
     BASE_FONT, PAD_LR, PAD_TB, SPACER_S, SPACER_M, SPACER_L, MARGINS = 9, 1, 0.5, 2, 4, 8, 18
-    buffer = BytesIO()
+    buffer = BytesIO() if output is None else output
     doc = BaseDocTemplate(buffer, pagesize=letter, leftMargin=MARGINS, rightMargin=MARGINS, topMargin=24, bottomMargin=24)
     gap = 10
     fw, fh = (doc.width - gap) / 2, doc.height
     frames = [Frame(doc.leftMargin, doc.bottomMargin, fw, fh),
               Frame(doc.leftMargin + fw + gap, doc.bottomMargin, fw, fh)]
     doc.addPageTemplates([PageTemplate(id="TwoCol", frames=frames)])
-    styles = getSampleStyleSheet()
-    cat_h = ParagraphStyle("CatH", parent=styles["Heading3"], alignment=1, fontSize=BASE_FONT+3, leading=BASE_FONT+4)
-    sub_h = ParagraphStyle("SubH", parent=styles["Heading4"], alignment=0, fontSize=BASE_FONT+1, leading=BASE_FONT+2)
-    normal = ParagraphStyle("Norm", parent=styles["Normal"], fontSize=BASE_FONT, leading=BASE_FONT+1)
+    cat_h = _style("CatH", "Heading3", alignment=1, fontSize=BASE_FONT+3, leading=BASE_FONT+4)
+    sub_h = _style("SubH", "Heading4", alignment=0, fontSize=BASE_FONT+1, leading=BASE_FONT+2)
+    normal = _style("Norm", "Normal", fontSize=BASE_FONT, leading=BASE_FONT+1)
+    prod_styles = lineage_styles(normal, "P")
     elements = []
-    order = ["Plain Prerolls","Plain Blunts","Infused Prerolls","Infused Blunts","Flavored","Preroll Packs","Infused Preroll Packs"]
-    for cat in [c for c in order if grouped_data.get(c)]:
+    for cat, groups in (prepared or prepare_preroll(preroll_rows(grouped_data))).items():
         if cat in ("Infused Prerolls", "Preroll Packs") and elements:
             elements.append(PageBreak())
         elements.extend([Paragraph(cat, cat_h), Spacer(1, SPACER_S)])
-        gmap = {
-            k: sorted(v, key=lambda i: (get_price_info(i)[1], get_lineage_order(get_lineage_abbr(i)), (prefer_strain(i) or "").lower()))
-            for k, v in group_by_brand_unit(grouped_data[cat]).items()
-        }
-        sorted_keys = sorted(gmap.keys(), key=lambda k: (min((get_price_info(i)[1] for i in gmap[k]), default=9e9), k[0].lower(), k[1].lower()))
-        for brand, unit in sorted_keys:
-            subitems = gmap[(brand, unit)]
-            if not subitems: continue
-            min_price = get_price_info(subitems[0])[1]
-            pack_sz = extract_pack_size(subitems[0].get("name") or "")
+        for brand, unit, min_price, pack_sz, rows in groups:
             head = f"{brand} {unit} ${min_price:.2f}" + (f" {pack_sz} pack" if pack_sz else "")
             flow = [Paragraph(head, sub_h), Spacer(1, SPACER_S)]
 
@@ -304,84 +652,67 @@ def generate_preroll_pdf_condensed(grouped_data, store=None):
 
             col_w = [fw*0.5, fw*0.25, fw*0.25]
             data = [hdr]
-            for it in subitems:
-                name = process_flavored_title(it.get("name") or "") if cat == "Flavored" else prefer_strain(it)
+            for r in rows:
+                name = process_flavored_title(r.name) if cat == "Flavored" else r.strain
                 t_name = truncate_text(name, col_w[0], "Helvetica", BASE_FONT)
-                p_par = Paragraph(t_name, ParagraphStyle("P", parent=normal, textColor=determine_lineage_color(it)))
-                thc, cbd = it.get("thc", {}).get("current", ""), format_cbd_value(it.get("cbd", {}).get("current", ""))
-                data.append([p_par, thc, cbd])
+                p_par = Paragraph(t_name, prod_styles[r.lineage_abbr])
+                data.append([p_par, r.thc, format_cbd_value(r.cbd)])
 
             tbl = Table(data, colWidths=col_w)
-            sty = TableStyle([
-                ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0,0), (-1,0), BASE_FONT),
-                ('BACKGROUND', (0,0), (-1,0), colors.grey),
-                ('ALIGN', (1,0), (-1,-1), 'CENTER'),
-                ('GRID', (0,0), (-1,-1), 0.25, colors.black),
-                ('FONTNAME', (0,1), (-1,-1), 'Helvetica'),
-                ('FONTSIZE', (0,1), (-1,-1), BASE_FONT),
-                ('LEFTPADDING', (0,0), (-1,-1), PAD_LR),
-                ('RIGHTPADDING', (0,0), (-1,-1), PAD_LR),
-                ('TOPPADDING', (0,0), (-1,-1), PAD_TB),
-                ('BOTTOMPADDING', (0,0), (-1,-1), PAD_TB)
-            ])
-            for i, it in enumerate(subitems, start=1):
-                if store and has_discount_tag_for_store(it, 30, store):
-                    sty.add('BACKGROUND', (0, i), (0, i), colors.yellow)
-                elif store and has_discount_tag_for_store(it, 50, store):
-                    sty.add('BACKGROUND', (0, i), (0, i), colors.lightblue)
-            tbl.setStyle(sty)
+            tbl.setStyle(_group_table_style(BASE_FONT, PAD_LR, PAD_TB))
+            tbl.setStyle(discount_highlights((r.item for r in rows), store, col=0))
 
             flow.extend([tbl, Spacer(1, SPACER_M)])
-            elements.append(KeepTogether(flow))
+            elements.extend(keep_group(flow, len(rows)))
         elements.append(Spacer(1, SPACER_L))
     doc.build(elements)
-    pdf_data = buffer.getvalue()
-    buffer.close()
-    return pdf_data
+    return _pdf_bytes(buffer, output)
 
 # ------------------------------ CART & DAB ------------------------------
 def process_cart_dab_title(title):
     if not title: return ""
     return title.split("-", 1)[1].strip() if "-" in title else title.strip()
 
-def is_thc_mg_item(item):
-    product_type = (item.get("product_type") or "").lower()
-    title = (item.get("name") or "").lower()
-    return any(term in product_type or term in title for term in ["flavored", "combined", "concentrate"])
+def _lowered(item):
+    return (item.get("name") or "").lower(), (item.get("product_type") or "").lower(), (item.get("brand") or "").lower()
 
-def is_flavored_item(item):
-    brand = (item.get("brand") or "").lower()
-    if "verdant leaf" in brand:
-        return False
-    product_type = (item.get("product_type") or "").lower()
-    name = (item.get("name") or "").lower()
+def _thc_mg(name, product_type):
+    return any(term in product_type or term in name for term in ("flavored", "combined", "concentrate"))
+
+def _flavored(name, product_type, brand):
+    if "verdant leaf" in brand: return False
     return "flavored" in product_type or "combined" in product_type or "flavored" in name
 
-def is_disposable_item(item):
-    name = (item.get("name") or "").lower()
-    keywords = ["dispos", "all in one", "all-in-one", "allinone"]
-    return any(keyword in name for keyword in keywords)
+def _disposable(name):
+    return any(keyword in name for keyword in ("dispos", "all in one", "all-in-one", "allinone"))
 
-def group_by_brand_unit_price(items):
-    groups = {}
-    for item in items:
-        brand = (item.get("brand") or "").strip()
-        unit, price = get_price_info(item)
-        groups.setdefault((brand, unit, price), []).append(item)
-    return groups
+def is_thc_mg_item(item):
+    name, product_type, _ = _lowered(item)
+    return _thc_mg(name, product_type)
 
-def sort_cart_dab_groups(items):
-    group_map = group_by_brand_unit_price(items)
-    sorted_keys = sorted(group_map.keys(), key=lambda k: (k[2], k[0].lower(), k[1].lower()))
-    return [
-        (k[0], k[1], k[2],
-         sorted(group_map[k], key=lambda i: (get_price_info(i)[1], get_lineage_order(get_lineage_abbr(i)), (prefer_strain(i) or "").lower()))
-        ) for k in sorted_keys
-    ]
+def is_flavored_item(item): return _flavored(*_lowered(item))
+def is_disposable_item(item): return _disposable(_lowered(item)[0])
+
+def annotate(item):
+    """(is_flavored, is_disposable, is_thc_mg) from a single lowercasing of the item's text fields."""
+    name, product_type, brand = _lowered(item)
+    return _flavored(name, product_type, brand), _disposable(name), _thc_mg(name, product_type)
 
-def generate_cart_dab_pdf(items, menu_title, font_size=12, store=None):
-    buffer = BytesIO()
+def sort_cart_dab_groups(items):
+    """[(brand, unit, price, rows)] cheapest first; each item becomes an ItemRow once, and the
+    renderers read the same rows the sort keyed on."""
+    groups = defaultdict(list)
+    for r in map(to_row, items):
+        groups[(r.brand.strip(), r.unit, r.price)].append((_row_sort_key(r), r))
+    order = sorted((((price, brand.lower(), unit.lower()), (brand, unit, price)) for brand, unit, price in groups), key=_by_key)
+    out = []
+    for _, k in order:
+        dec = sorted(groups[k], key=_by_key)
+        out.append((*k, [r for _, r in dec]))
+    return out
+
+def generate_cart_dab_pdf(items, menu_title, font_size=12, store=None, output=None):
+    buffer = BytesIO() if output is None else output
     doc = BaseDocTemplate(buffer, pagesize=letter, leftMargin=24, rightMargin=24, topMargin=36, bottomMargin=36)
     gap = 12
     fw, fh = (doc.width - gap) / 2, doc.height
@@ -389,49 +720,33 @@ def generate_cart_dab_pdf(items, menu_title, font_size=12, store=None):
               Frame(doc.leftMargin + fw + gap, doc.bottomMargin, fw, fh)]
     doc.addPageTemplates([PageTemplate(id='TwoCol', frames=frames)])
     groups = sort_cart_dab_groups(items)
-    styles = getSampleStyleSheet()
-    header_style = ParagraphStyle("Header", parent=styles["Heading1"], alignment=1, fontSize=font_size+4)
-    sub_header_style = ParagraphStyle("SubHeader", parent=styles["Heading2"], alignment=0, fontSize=font_size+2)
-    normal_style = ParagraphStyle("Normal", parent=styles["Normal"], fontSize=font_size)
+    header_style = _style("Header", "Heading1", alignment=1, fontSize=font_size+4)
+    sub_header_style = _style("SubHeader", "Heading2", alignment=0, fontSize=font_size+2)
+    normal_style = _style("Normal", "Normal", fontSize=font_size)
+    prod_styles = lineage_styles(normal_style, "Prod")
     elements = [Paragraph(menu_title, header_style), Spacer(1, 12)]
-    for brand, unit, price, subitems in groups:
+    for brand, unit, price, rows in groups:
         sub_header = f"{brand} {unit} ${price:.2f}"
         sub_flow = [Paragraph(sub_header, sub_header_style), Spacer(1, 6)]
-        hdr = ["Product Name", "THC MG", "CBD MG"] if any(is_thc_mg_item(it) for it in subitems) else ["Product Name", "THC %", "CBD %"]
+        hdr = ["Product Name", "THC MG", "CBD MG"] if any(is_thc_mg_item(r.item) for r in rows) else ["Product Name", "THC %", "CBD %"]
         col_w = [fw * 0.5, fw * 0.25, fw * 0.25]
         data = [hdr]
-        for it in subitems:
-            name = truncate_text(process_cart_dab_title(it.get("name") or ""), col_w[0], "Helvetica", font_size)
-            p_par = Paragraph(name, ParagraphStyle("Prod", parent=normal_style, textColor=determine_lineage_color(it)))
-            thc, cbd = it.get("thc", {}).get("current", ""), format_cbd_value(it.get("cbd", {}).get("current", ""))
-            data.append([p_par, thc, cbd])
+        for r in rows:
+            name = truncate_text(process_cart_dab_title(r.name), col_w[0], "Helvetica", font_size)
+            p_par = Paragraph(name, prod_styles[r.lineage_abbr])
+            data.append([p_par, r.thc, format_cbd_value(r.cbd)])
         tbl = Table(data, colWidths=col_w)
-        sty = TableStyle([
-            ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0,0), (-1,0), font_size),
-            ('BACKGROUND', (0,0), (-1,0), colors.grey),
-            ('ALIGN', (1,0), (-1,-1), 'CENTER'),
-            ('GRID', (0,0), (-1,-1), 0.25, colors.black),
-            ('FONTNAME', (0,1), (-1,-1), 'Helvetica'),
-            ('FONTSIZE', (0,1), (-1,-1), font_size)
-        ])
-        for i, it in enumerate(subitems, start=1):
-            if store and has_discount_tag_for_store(it, 30, store):
-                sty.add('BACKGROUND', (0, i), (0, i), colors.yellow)
-            elif store and has_discount_tag_for_store(it, 50, store):
-                sty.add('BACKGROUND', (0, i), (0, i), colors.lightblue)
-        tbl.setStyle(sty)
+        tbl.setStyle(_group_table_style(font_size))
+        tbl.setStyle(discount_highlights((r.item for r in rows), store, col=0))
 
         sub_flow.extend([tbl, Spacer(1, 12)])
-        elements.append(KeepTogether(sub_flow))
+        elements.extend(keep_group(sub_flow, len(rows)))
     doc.build(elements)
-    pdf_data = buffer.getvalue()
-    buffer.close()
-    return pdf_data
+    return _pdf_bytes(buffer, output)
 
-def generate_cart_dab_pdf_condensed(items, menu_title, store=None):
+def generate_cart_dab_pdf_condensed(items, menu_title, store=None, output=None):
     BASE_FONT, PAD_LR, PAD_TB, SPACER_S, SPACER_M, MARGINS = 9, 1, 0.5, 2, 4, 18
-    buffer = BytesIO()
+    buffer = BytesIO() if output is None else output
     doc = BaseDocTemplate(buffer, pagesize=letter, leftMargin=MARGINS, rightMargin=MARGINS, topMargin=24, bottomMargin=24)
     gap = 10
     fw, fh = (doc.width - gap) / 2, doc.height
@@ -439,12 +754,13 @@ def generate_cart_dab_pdf_condensed(items, menu_title, store=None):
               Frame(doc.leftMargin + fw + gap, doc.bottomMargin, fw, fh)]
     doc.addPageTemplates([PageTemplate(id="TwoCol", frames=frames)])
 
-    styles = getSampleStyleSheet()
-    head_style = ParagraphStyle("Head", parent=styles["Heading1"], alignment=1, fontSize=BASE_FONT+4, leading=BASE_FONT+5)
-    section_style = ParagraphStyle("Sub", parent=styles["Heading2"], alignment=0, fontSize=BASE_FONT+2, leading=BASE_FONT+3)
-    body_style = ParagraphStyle("Body", parent=styles["Normal"], fontSize=BASE_FONT, leading=BASE_FONT+1)
+    head_style = _style("Head", "Heading1", alignment=1, fontSize=BASE_FONT+4, leading=BASE_FONT+5)
+    section_style = _style("Sub", "Heading2", alignment=0, fontSize=BASE_FONT+2, leading=BASE_FONT+3)
+    body_style = _style("Body", "Normal", fontSize=BASE_FONT, leading=BASE_FONT+1)
+    prod_styles = lineage_styles(body_style, "P")
 
     elements = []
+    notes = {id(it): annotate(it) for it in items}
 
     def render_section(title, items_list, page_break=False, is_main_header=False):
         if not items_list:
@@ -456,47 +772,28 @@ def generate_cart_dab_pdf_condensed(items, menu_title, store=None):
         elements.append(Spacer(1, SPACER_M))
 
         groups_to_render = sort_cart_dab_groups(items_list)
-        for brand, unit, price, subitems in groups_to_render:
+        for brand, unit, price, rows in groups_to_render:
             hdr_txt = f"{brand} {unit} ${price:.2f}"
             flow = [Paragraph(hdr_txt, section_style), Spacer(1, SPACER_S)]
-            hdr = ["Product Name", "THC MG", "CBD MG"] if any(is_thc_mg_item(it) for it in subitems) else ["Product Name", "THC %", "CBD %"]
+            hdr = ["Product Name", "THC MG", "CBD MG"] if any(notes[id(r.item)][2] for r in rows) else ["Product Name", "THC %", "CBD %"]
             col_w = [fw * 0.5, fw * 0.25, fw * 0.25]
             data = [hdr]
-            for it in subitems:
-                name = truncate_text(process_cart_dab_title(it.get("name") or ""), col_w[0], "Helvetica", BASE_FONT)
-                prod = Paragraph(name, ParagraphStyle("P", parent=body_style, textColor=determine_lineage_color(it)))
-                thc, cbd = it.get("thc", {}).get("current", ""), format_cbd_value(it.get("cbd", {}).get("current", ""))
-                data.append([prod, thc, cbd])
+            for r in rows:
+                name = truncate_text(process_cart_dab_title(r.name), col_w[0], "Helvetica", BASE_FONT)
+                prod = Paragraph(name, prod_styles[r.lineage_abbr])
+                data.append([prod, r.thc, format_cbd_value(r.cbd)])
 
             tbl = Table(data, colWidths=col_w)
-            sty = TableStyle([
-                ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0,0), (-1,0), BASE_FONT),
-                ('BACKGROUND', (0,0), (-1,0), colors.grey),
-                ('ALIGN', (1,0), (-1,-1), 'CENTER'),
-                ('GRID', (0,0), (-1,-1), 0.25, colors.black),
-                ('FONTNAME', (0,1), (-1,-1), 'Helvetica'),
-                ('FONTSIZE', (0,1), (-1,-1), BASE_FONT),
-                ('LEFTPADDING', (0,0), (-1,-1), PAD_LR),
-                ('RIGHTPADDING', (0,0), (-1,-1), PAD_LR),
-                ('TOPPADDING', (0,0), (-1,-1), PAD_TB),
-                ('BOTTOMPADDING', (0,0), (-1,-1), PAD_TB)
-            ])
-            for i, it in enumerate(subitems, start=1):
-                if store and has_discount_tag_for_store(it, 30, store):
-                    sty.add('BACKGROUND', (0, i), (0, i), colors.yellow)
-                elif store and has_discount_tag_for_store(it, 50, store):
-                    sty.add('BACKGROUND', (0, i), (0, i), colors.lightblue)
-            tbl.setStyle(sty)
+            tbl.setStyle(_group_table_style(BASE_FONT, PAD_LR, PAD_TB))
+            tbl.setStyle(discount_highlights((r.item for r in rows), store, col=0))
 
             flow.extend([tbl, Spacer(1, SPACER_M)])
-            elements.append(KeepTogether(flow))
+            elements.extend(keep_group(flow, len(rows)))
 
     if "CART" in menu_title.upper():
         carts, flavored_carts, disposables, flavored_disposables = [], [], [], []
         for item in items:
-            is_disp = is_disposable_item(item)
-            is_flav = is_flavored_item(item)
+            is_flav, is_disp, _ = notes[id(item)]
             if is_disp and is_flav:
                 flavored_disposables.append(item)
             elif is_disp:
@@ -514,9 +811,7 @@ def generate_cart_dab_pdf_condensed(items, menu_title, store=None):
         render_section(menu_title, items, is_main_header=True)
 
     doc.build(elements)
-    pdf_data = buffer.getvalue()
-    buffer.close()
-    return pdf_data
+    return _pdf_bytes(buffer, output)
 
 # ------------------------------ PREPACK ------------------------------
 def get_special_designation(item):
@@ -525,13 +820,21 @@ def get_special_designation(item):
     if "shake" in name_lower: return "Shake"
     return ""
 
-def sort_items_by_price_and_lineage(items):
-    def sort_key(item):
-        price = item.get("prices", [{}])[0].get("price_cents", 999999)
-        lineage_val = get_lineage_order(get_lineage_abbr(item))
-        strain = prefer_strain(item).lower()
-        return (price, lineage_val, strain)
-    return sorted(items, key=sort_key)
+def bucket_prepack(items):
+    """(shake, regular, last_of) in one pass; designation picks the list by dict lookup."""
+    shake, regular, last_of = [], [], []
+    buckets = {"Shake": shake, "Last of Flower / As Is": last_of}
+    for it in items:
+        buckets.get(get_special_designation(it), regular).append(it)
+    return shake, regular, last_of
+
+def _prepack_row_key(r):
+    price = (r.item.get("prices") or [{}])[0].get("price_cents", 999999)
+    return (price, LINEAGE_ORDER.get(r.lineage_abbr, 99), r.strain.lower())
+
+# Sorting ItemRows lets the table builders reuse the lineage/strain the sort already derived.
+def sort_prepack_rows(rows): return sorted(rows, key=_prepack_row_key)
+def sort_items_by_price_and_lineage(items): return [r.item for r in sort_prepack_rows(map(to_row, items))]
 
 def get_all_weights(item):
     prices = item.get("prices", [])
@@ -542,55 +845,32 @@ def get_all_weights(item):
         if unit: displays.add(f"{unit}{unit_type[0] if unit_type else ''}")
     return ", ".join(sorted(list(displays)))
 
-def generate_prepack_pdf(items, font_size=9, store=None):
-    buffer = BytesIO()
+def prepack_cells(r, strain_w, font_size):
+    """Lineage / price / grams / strain / THC cells of one prepack row (full and condensed)."""
+    return [r.lineage_abbr, price_label(r.price), get_all_weights(r.item),
+            truncate_text(r.strain, strain_w, "Helvetica", font_size), f"{r.thc}%" if r.thc else ""]
+
+def generate_prepack_pdf(items, font_size=9, store=None, output=None):
+    buffer = BytesIO() if output is None else output
     doc = SimpleDocTemplate(buffer, pagesize=letter, leftMargin=36, rightMargin=36, topMargin=36, bottomMargin=36)
     elements = []
-    styles = getSampleStyleSheet()
-    shake, regular, last_of = [], [], []
-    for item in items:
-        designation = get_special_designation(item)
-        if designation == "Shake": shake.append(item)
-        elif designation == "Last of Flower / As Is": last_of.append(item)
-        else: regular.append(item)
-    shake = sort_items_by_price_and_lineage(shake)
-    regular = sort_items_by_price_and_lineage(regular)
-    last_of = sort_items_by_price_and_lineage(last_of)
-
-    main_header = ParagraphStyle("MainHeader", parent=styles["Heading1"], alignment=1, fontSize=14, spaceAfter=12)
-    section_header = ParagraphStyle("SectionHeader", parent=styles["Heading2"], alignment=0, fontSize=11, spaceBefore=6, spaceAfter=6)
+    shake, regular, last_of = bucket_prepack(items)
+    shake = sort_prepack_rows(map(to_row, shake))
+    regular = sort_prepack_rows(map(to_row, regular))
+    last_of = sort_prepack_rows(map(to_row, last_of))
+
+    main_header = _style("MainHeader", "Heading1", alignment=1, fontSize=14, spaceAfter=12)
+    section_header = _style("SectionHeader", "Heading2", alignment=0, fontSize=11, spaceBefore=6, spaceAfter=6)
     col_widths = [doc.width * f for f in [0.12, 0.12, 0.18, 0.40, 0.18]]
 
-    def create_table(data_items):
-        if not data_items: return None
+    def create_table(rows):
+        if not rows: return None
         header = ["Lineage", "Price", "Grams", "Strain Name", "THC"]
-        table_data = [header]
-        for it in data_items:
-            abbr = get_lineage_abbr(it)
-            price = f"${get_price_info(it)[1]:.2f}" if get_price_info(it)[1] else ""
-            grams = get_all_weights(it)
-            strain = truncate_text(prefer_strain(it), col_widths[3], "Helvetica", font_size)
-            thc = f"{it.get('thc', {}).get('current', '')}%" if it.get('thc', {}).get('current') else ""
-            table_data.append([abbr, price, grams, strain, thc])
+        table_data = [header] + [prepack_cells(r, col_widths[3], font_size) for r in rows]
         tbl = Table(table_data, colWidths=col_widths, repeatRows=1)
-        style = TableStyle([
-            ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0,0), (-1,0), font_size+1),
-            ('BACKGROUND', (0,0), (-1,0), colors.darkgrey),
-            ('TEXTCOLOR', (0,0), (-1,0), colors.whitesmoke),
-            ('ALIGN', (0,0), (-1,-1), 'CENTER'),
-            ('GRID', (0,0), (-1,-1), 0.5, colors.black),
-            ('FONTNAME', (0,1), (-1,-1), 'Helvetica'),
-            ('FONTSIZE', (0,1), (-1,-1), font_size),
-        ])
-        for i, row_item in enumerate(data_items, start=1):
-            style.add("TEXTCOLOR", (0, i), (0, i), determine_lineage_color(row_item))
-            style.add("FONTNAME", (3, i), (3, i), "Helvetica-Bold")
-            if store and has_discount_tag_for_store(row_item, 30, store):
-                style.add('BACKGROUND', (3, i), (3, i), colors.yellow)
-            elif store and has_discount_tag_for_store(row_item, 50, store):
-                style.add('BACKGROUND', (3, i), (3, i), colors.lightblue)
-        tbl.setStyle(style)
+        tbl.setStyle(_prepack_table_style(font_size))
+        tbl.setStyle(TableStyle(column_runs("TEXTCOLOR", 0, [r.lineage_color for r in rows]) +
+                                discount_highlights((r.item for r in rows), store, col=3)))
         return tbl
 
     elements.append(Paragraph("Prepack Specials", main_header))
@@ -607,77 +887,42 @@ def generate_prepack_pdf(items, font_size=9, store=None):
 
     if any([shake, regular, last_of]):
         doc.build(elements)
-    pdf_data = buffer.getvalue()
-    buffer.close()
-    return pdf_data
+    return _pdf_bytes(buffer, output)
 
-def generate_prepack_pdf_condensed(items, store=None):
+def generate_prepack_pdf_condensed(items, store=None, output=None):
     BASE_FONT, PAD_LR, PAD_TB, SPACER_S, SPACER_M, MARGINS, GAP = 9, 1, 0.5, 2, 4, 18, 10
-    buffer = BytesIO()
+    buffer = BytesIO() if output is None else output
     doc = BaseDocTemplate(buffer, pagesize=letter, leftMargin=MARGINS, rightMargin=MARGINS, topMargin=24, bottomMargin=24)
     fw, fh = (doc.width - GAP) / 2, doc.height
     frames = [Frame(doc.leftMargin, doc.bottomMargin, fw, fh),
               Frame(doc.leftMargin + fw + GAP, doc.bottomMargin, fw, fh)]
     doc.addPageTemplates([PageTemplate(id="TwoCol", frames=frames)])
-    styles = getSampleStyleSheet()
-    head_style = ParagraphStyle("Head", parent=styles["Heading1"], alignment=1, fontSize=BASE_FONT+4, leading=BASE_FONT+5)
-    section_style = ParagraphStyle("Section", parent=styles["Heading2"], alignment=0, fontSize=BASE_FONT+2, leading=BASE_FONT+3)
+    head_style = _style("Head", "Heading1", alignment=1, fontSize=BASE_FONT+4, leading=BASE_FONT+5)
+    section_style = _style("Section", "Heading2", alignment=0, fontSize=BASE_FONT+2, leading=BASE_FONT+3)
     elements = [Paragraph("PREPACK MENU", head_style), Spacer(1, SPACER_M)]
-    shake, regular, last_of = [], [], []
-    for it in items:
-        d = get_special_designation(it)
-        if d == "Shake": shake.append(it)
-        elif d == "Last of Flower / As Is": last_of.append(it)
-        else: regular.append(it)
+    shake, regular, last_of = bucket_prepack(items)
 
-    def make_table(data_items):
-        if not data_items: return None
+    def make_table(rows):
+        if not rows: return None
         header = ["Lin.", "Price", "Grams", "Strain", "THC"]
         col_w = [fw * f for f in [0.12, 0.12, 0.18, 0.4, 0.18]]
-        rows = [header]
-        for it in data_items:
-            lin_abbr = get_lineage_abbr(it)
-            price = f"${get_price_info(it)[1]:.2f}" if get_price_info(it)[1] else ""
-            strain = truncate_text(prefer_strain(it), col_w[3], "Helvetica", BASE_FONT)
-            grams = get_all_weights(it)
-            thc = f"{it.get('thc', {}).get('current', '')}%" if it.get('thc', {}).get('current') else ""
-            rows.append([lin_abbr, price, grams, strain, thc])
-        tbl = Table(rows, colWidths=col_w, repeatRows=1)
-        style = TableStyle([
-            ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0,0), (-1,0), BASE_FONT),
-            ('BACKGROUND', (0,0), (-1,0), colors.grey),
-            ('TEXTCOLOR', (0,0), (-1,0), colors.whitesmoke),
-            ('ALIGN', (0,0), (-1,0), 'CENTER'),
-            ('FONTNAME', (0,1), (-1,-1), 'Helvetica'),
-            ('FONTSIZE', (0,1), (-1,-1), BASE_FONT),
-            ('LEFTPADDING', (0,0), (-1,-1), PAD_LR),
-            ('RIGHTPADDING', (0,0), (-1,-1), PAD_LR),
-            ('TOPPADDING', (0,0), (-1,-1), PAD_TB),
-            ('BOTTOMPADDING', (0,0), (-1,-1), PAD_TB),
-            ('GRID', (0,0), (-1,-1), 0.25, colors.black),
-        ])
-        for idx, row_it in enumerate(data_items, start=1):
-            style.add("TEXTCOLOR", (0, idx), (0, idx), determine_lineage_color(row_it))
-            style.add("FONTNAME", (3, idx), (3, idx), "Helvetica-Bold")
-            if store and has_discount_tag_for_store(row_it, 30, store):
-                style.add('BACKGROUND', (3, idx), (3, idx), colors.yellow)
-            elif store and has_discount_tag_for_store(row_it, 50, store):
-                style.add('BACKGROUND', (3, idx), (3, idx), colors.lightblue)
-        tbl.setStyle(style)
+        table = [header] + [prepack_cells(r, col_w[3], BASE_FONT) for r in rows]
+        tbl = Table(table, colWidths=col_w, repeatRows=1)
+        tbl.setStyle(_prepack_condensed_table_style(BASE_FONT, PAD_LR, PAD_TB))
+        tbl.setStyle(TableStyle(column_runs("TEXTCOLOR", 0, [r.lineage_color for r in rows]) +
+                                discount_highlights((r.item for r in rows), store, col=3)))
         return tbl
 
     for label, items_list in [("Shake", shake), ("Regular Prepacks", regular), ("Last Of Flower / As Is", last_of)]:
         if not items_list: continue
         flow = [Paragraph(label, section_style), Spacer(1, SPACER_S)]
-        tbl = make_table(sort_items_by_price_and_lineage(items_list))
+        rows = sort_prepack_rows(map(to_row, items_list))
+        tbl = make_table(rows)
         if tbl: flow.extend([tbl, Spacer(1, SPACER_M)])
-        elements.append(KeepTogether(flow))
+        elements.extend(keep_group(flow, len(rows), min_space=120))
 
     if len(elements) > 2: doc.build(elements)
-    pdf_data = buffer.getvalue()
-    buffer.close()
-    return pdf_data
+    return _pdf_bytes(buffer, output)
 
 # ------------------------------ FLOWER (with footer legend; uses prefer_strain) ------------------------------
 PRICING = {
@@ -685,98 +930,100 @@ PRICING = {
     "Platinum":{"REC":"Gram - $14.00, Eighth - $40.00, Quarter - $72.00, Half-Oz - $135.00, Ounce - $250.00","MED":"Gram - $11.67, Eighth - $33.33, Quarter - $60.00, Half-Oz - $112.50, Ounce - $208.33"},
     "Gold":{"REC":"Gram - $6, Eighth - $18, Quarter - $34, Half-Oz - $65, Ounce - $125","MED":"Gram - $5, Eighth - $14.40, Quarter - $28.33, Half-Oz - $54.17, Ounce - $104.17"}
 }
-ALLOWED_ROOMS = {"Floor Stock", "Floor Stock : Diamond"}
+ALLOWED_ROOMS = frozenset({"Floor Stock", "Floor Stock : Diamond"})
 
 def extract_flower_data(menu_feed):
     items = []
     for it in extract_all_items(menu_feed):
-        rooms = it.get("rooms", [])
-        if not rooms or any(r in ALLOWED_ROOMS for r in rooms):
+        rooms = it.get("rooms")
+        # no rooms listed, or at least one of them is a room we sell from
+        if not rooms or not ALLOWED_ROOMS.isdisjoint(rooms):
             items.append(it)
     return items
 
 def filter_by_tier(items, tier):
     return [it for it in items if (it.get("tier_name","") or "").strip().lower() == tier.lower()]
 
-def sort_flower_items(items):
-    def price_cents(it): return (it.get("prices") or [{}])[0].get("price_cents", 0) or 0
-    def k(it):
-        return (
-            get_lineage_order(get_lineage_abbr(it)),
-            prefer_strain(it).lower(),                   # use clean strain for ordering
-            (it.get("brand") or "").strip().lower(),
-            price_cents(it),
-            str(it.get("id") or it.get("uuid") or it.get("sku") or "")
-        )
-    return sorted(items, key=k)
-
-def generate_flower_pdf(items, store=None, font_size=12):
-    buffer = BytesIO()
+def bucket_by_tier(items, tiers):
+    """{tier: items} in one pass, instead of one filter_by_tier scan per tier."""
+    buckets = {t.lower(): [] for t in tiers}
+    for it in items:
+        b = buckets.get((it.get("tier_name","") or "").strip().lower())
+        if b is not None: b.append(it)
+    return {t: buckets[t.lower()] for t in tiers}
+
+def _flower_row_key(r):
+    it = r.item
+    return (
+        LINEAGE_ORDER.get(r.lineage_abbr, 99),
+        r.strain.lower(),                            # use clean strain for ordering
+        r.brand.strip().lower(),
+        r.price,
+        str(it.get("id") or it.get("uuid") or it.get("sku") or "")
+    )
+
+def sort_flower_rows(rows): return sorted(rows, key=_flower_row_key)
+def sort_flower_items(items): return [r.item for r in sort_flower_rows(map(to_row, items))]
+
+# Rows per flower sub-table (header included in the first)
+FLOWER_TABLE_CHUNK = 30
+
+def generate_flower_pdf(items, store=None, font_size=12, output=None):
+    tiers = ["Diamond","Platinum","Gold"]
+    by_tier = bucket_by_tier(items, tiers)
+    if not any(by_tier.values()): return None if output is not None else b""  # nothing to lay out
+
+    buffer = BytesIO() if output is None else output
     doc = SimpleDocTemplate(buffer, pagesize=letter, leftMargin=36, rightMargin=36, topMargin=36, bottomMargin=36)
     all_flow = []
-    styles = getSampleStyleSheet()
-    header = ParagraphStyle("Header", parent=styles["Heading1"], alignment=1, fontSize=14)
-    pricing = ParagraphStyle("Pricing", parent=styles["Normal"], fontSize=12)
+    header = _style("Header", "Heading1", alignment=1, fontSize=14)
+    pricing = _style("Pricing", "Normal", fontSize=12)
 
-    for ti, tier in enumerate(["Diamond","Platinum","Gold"]):
-        tier_items = filter_by_tier(items, tier)
-        if not tier_items: continue
+    colw = [doc.width*f for f in [0.1,0.35,0.25,0.15,0.15]]
+    strain_w, brand_w = colw[1] - font_size, colw[2] - font_size  # text room inside the padding
+    legend_style_y = _style("LegendY", "Normal", fontSize=8, alignment=1, backColor=colors.yellow)
+    legend_style_b = _style("LegendB", "Normal", fontSize=8, alignment=1, backColor=colors.lightblue)
+    def build_tier(tier):
+        tier_items = by_tier[tier]
+        if not tier_items: return []
 
         flow = [Paragraph(f"{tier.upper()} SHELF", header), Spacer(1,12),
                 Paragraph(f"REC: {PRICING[tier]['REC']}", pricing),
                 Paragraph(f"MED: {PRICING[tier]['MED']}", pricing),
                 Spacer(1,12)]
 
-        data = [["Lineage","Strain","Farm","THC%","CBD%"]]
-        colw = [doc.width*f for f in [0.1,0.35,0.25,0.15,0.15]]
-        sorted_items = sort_flower_items(tier_items)
-
-        for it in sorted_items:
-            strain = prefer_strain(it)
-            data.append([
-                get_lineage_abbr(it),
-                truncate_text(strain, colw[1]-font_size, "Helvetica", font_size),
-                truncate_text(it.get("brand",""), colw[2]-font_size, "Helvetica", font_size),
-                it.get("thc",{}).get("current",""),
-                format_cbd_value(it.get("cbd",{}).get("current",""))
-            ])
-
-        tbl = Table(data, colWidths=colw)
-        sty = TableStyle([
-            ('FONTNAME',(0,0),(-1,0),'Helvetica-Bold'),
-            ('FONTSIZE',(0,0),(-1,0),font_size),
-            ('ALIGN',(0,0),(-1,0),'CENTER'),
-            ('BOTTOMPADDING',(0,0),(-1,0),font_size*0.5+4),
-            ('GRID',(0,0),(-1,-1),0.25,colors.black),
-            ('FONTNAME',(0,1),(-1,-1),'Helvetica'),
-            ('FONTSIZE',(0,1),(-1,-1),font_size),
-            ('LEFTPADDING',(0,0),(-1,-1),font_size*0.5),
-            ('RIGHTPADDING',(0,0),(-1,-1),font_size*0.5),
-            ('TOPPADDING',(0,0),(-1,-1),font_size*0.5),
-            ('BOTTOMPADDING',(0,0),(-1,-1),font_size*0.5),
-        ])
-        for i, it in enumerate(sorted_items, start=1):
-            sty.add('TEXTCOLOR', (0,i), (0,i), determine_lineage_color(it))
-            if store and has_discount_tag_for_store(it, 30, store):
-                sty.add('BACKGROUND', (1,i), (1,i), colors.yellow)
-            elif store and has_discount_tag_for_store(it, 50, store):
-                sty.add('BACKGROUND', (1,i), (1,i), colors.lightblue)
-
-        tbl.setStyle(sty)
-        flow.append(tbl)
+        rows = sort_flower_rows(map(to_row, tier_items))  # derived and sorted once; rows and styles read it
+        data = [["Lineage","Strain","Farm","THC%","CBD%"]] + [[
+            r.lineage_abbr,
+            truncate_text(r.strain, strain_w, "Helvetica", font_size),
+            truncate_text(r.brand, brand_w, "Helvetica", font_size),
+            r.thc,
+            format_cbd_value(r.cbd)
+        ] for r in rows]
+
+        # Fixed-size sub-tables butted together: same grid as one long table, but each page
+        # split only re-lays out its own chunk instead of every remaining row.
+        for start in range(0, len(data), FLOWER_TABLE_CHUNK):
+            r0 = 1 if start == 0 else 0  # only the first chunk carries the header row
+            chunk = rows[start - 1 + r0:start - 1 + FLOWER_TABLE_CHUNK]
+            tbl = Table(data[start:start + FLOWER_TABLE_CHUNK], colWidths=colw)
+            tbl.setStyle(_flower_table_style(font_size, bool(r0)))
+            tbl.setStyle(TableStyle(column_runs('TEXTCOLOR', 0, [r.lineage_color for r in chunk], r0) +
+                                    column_runs('BACKGROUND', 1, [discount_color(r.item, store) for r in chunk], r0)))
+            flow.append(tbl)
 
         # Footer legend ONLY for Flower
-        legend_style_y = ParagraphStyle("LegendY", parent=styles["Normal"], fontSize=8, alignment=1, backColor=colors.yellow)
-        legend_style_b = ParagraphStyle("LegendB", parent=styles["Normal"], fontSize=8, alignment=1, backColor=colors.lightblue)
         legend = Table(
             [[Paragraph("30% OFF", legend_style_y), Paragraph("50% OFF", legend_style_b)]],
             colWidths=[doc.width / 2, doc.width / 2]
         )
         flow.extend([Spacer(1, 8), legend])
+        return flow
 
+    for flow in map(build_tier, tiers):  # tiers are independent; only doc.build is ordered
+        if not flow: continue
+        if all_flow: all_flow.append(PageBreak())  # only between tiers that actually render
         all_flow.extend(flow)
-        if ti < 2: all_flow.append(PageBreak())
 
     if all_flow: doc.build(all_flow)
-    pdf = buffer.getvalue(); buffer.close()
-    return pdf
+    return _pdf_bytes(buffer, output)
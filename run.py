@@ -1,14 +1,14 @@
 # run.py
-import os, sys, socket, threading, time, webbrowser
+import os, sys, socket, threading, time, webbrowser, multiprocessing
 from pathlib import Path
 
 SINGLETON_PORT = 54123
-IDLE_TIMEOUT_SECS = 120   # quit ~2 minutes after last tab closes
+IDLE_TIMEOUT_SECS = 120   # quit 2 minutes after the last request (open tabs ping every 30s)
 
 BASE_PATH = Path(getattr(sys, "_MEIPASS", Path(__file__).parent))
 os.chdir(BASE_PATH)
 
-from app import app, get_last_request, get_open_client_count
+from app import app, activity_event
 
 def _is_port_open(port: int) -> bool:
     try:
@@ -18,7 +18,7 @@ def _is_port_open(port: int) -> bool:
         return False
 
 def _serve():
-    app.run(host="127.0.0.1", port=SINGLETON_PORT, debug=False, use_reloader=False)
+    app.run(host="127.0.0.1", port=SINGLETON_PORT, debug=False, use_reloader=False, threaded=True)
 
 def main():
     if _is_port_open(SINGLETON_PORT):
@@ -27,21 +27,27 @@ def main():
 
     t = threading.Thread(target=_serve, daemon=True); t.start()
 
-    for _ in range(60):
+    # the server is usually up within a few ms: probe early, then back off (~6s budget as before)
+    delay, deadline = 0.02, time.monotonic() + 6
+    while time.monotonic() < deadline:
         if _is_port_open(SINGLETON_PORT):
             webbrowser.open(f"http://127.0.0.1:{SINGLETON_PORT}/")
             break
-        time.sleep(0.1)
+        time.sleep(delay); delay = min(delay * 2, 0.5)
 
     try:
+        # Sleep until a request arrives or the idle window runs out, instead of polling. A live
+        # tab's pings count as requests, so no request for the whole window means none is left.
+        last_activity = time.monotonic()
         while t.is_alive():
-            open_tabs = get_open_client_count()
-            last_ts = get_last_request()
-            if open_tabs == 0 and (time.time() - last_ts) > IDLE_TIMEOUT_SECS:
-                os._exit(0)  # graceful enough; ends Flask
-            time.sleep(2)
+            if activity_event.wait(timeout=max(0, last_activity + IDLE_TIMEOUT_SECS - time.monotonic())):
+                activity_event.clear()
+                last_activity = time.monotonic()  # activity restarts the clock
+                continue
+            os._exit(0)  # graceful enough; ends Flask
     except KeyboardInterrupt:
         pass
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # PDF render pool workers in the frozen (PyInstaller) build
     main()
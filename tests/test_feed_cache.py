@@ -0,0 +1,36 @@
+import os, sys, tempfile, threading, time, unittest
+
+os.environ["MENU_CACHE_DIR"] = tempfile.mkdtemp()  # keep the disk tier away from real feeds
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import menu_generator
+
+class FeedFailureTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = 0
+        self.orig_get = menu_generator._SESSION.get
+        menu_generator._SESSION.get = self.failing_get
+        menu_generator._feed_cache.clear()
+        menu_generator._feed_failed_at.clear()
+
+    def tearDown(self):
+        menu_generator._SESSION.get = self.orig_get
+        menu_generator._feed_failed_at.clear()
+
+    def failing_get(self, *args, **kwargs):
+        self.calls += 1
+        time.sleep(0.2)
+        raise menu_generator.requests.ConnectionError("upstream down")
+
+    def test_concurrent_callers_share_one_failed_fetch(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(menu_generator.fetch_menu_data("foster", "cart")))
+                   for _ in range(5)]
+        start = time.monotonic()
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [None] * 5)
+        self.assertLess(time.monotonic() - start, 0.6)  # nobody queued behind a second attempt
+
+if __name__ == "__main__":
+    unittest.main()